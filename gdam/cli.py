@@ -38,8 +38,6 @@ from pyinotify import (
     IN_MOVED_TO
 )
 
-from gdam.processor import GliderFileProcessor
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -71,6 +69,70 @@ def main():
              'Default is "mongodb://localhost:27017".',
         default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
     )
+    parser.add_argument(
+        "--configs",
+        help="Folder to look for per glider ingest.json configuration files, "
+             "using the same layout as gdam2nc. Default is no filtering.",
+        default=os.environ.get('GDAM_CONFIG', os.environ.get('GDAM2NC_CONFIG'))
+    )
+    parser.add_argument(
+        "--batch_size",
+        help='Number of documents to buffer before writing them to Mongo. '
+             'Default is 1000.',
+        type=int,
+        default=int(os.environ.get('GDAM_BATCH_SIZE', 1000))
+    )
+    parser.add_argument(
+        "--max_rss",
+        help='Memory ceiling in MB per segment. When processing a segment grows '
+             'the process by more than this, buffered documents are written '
+             'immediately. Default is no ceiling.',
+        type=float,
+        default=os.environ.get('GDAM_MAX_RSS')
+    )
+    parser.add_argument(
+        "--bucket_size",
+        help='Store up to this many rows per column oriented bucket document '
+             'instead of one document per row. Default is one document per row.',
+        type=int,
+        default=os.environ.get('GDAM_BUCKET_SIZE')
+    )
+    parser.add_argument(
+        "--bucket_seconds",
+        help='Start a new bucket document after this many seconds of data. '
+             'Can be combined with --bucket_size.',
+        type=float,
+        default=os.environ.get('GDAM_BUCKET_SECONDS')
+    )
+    parser.add_argument(
+        "--worker_count",
+        help='Number of gdam-cli instances sharing the data directory. '
+             'Gliders are split between them by a hash of their name. '
+             'Default is 1.',
+        type=int,
+        default=int(os.environ.get('GDAM_WORKER_COUNT', 1))
+    )
+    parser.add_argument(
+        "--worker_index",
+        help='Index of this instance, from 0 to --worker_count - 1.',
+        type=int,
+        default=int(os.environ.get('GDAM_WORKER_INDEX', 0))
+    )
+    parser.add_argument(
+        "--lease_seconds",
+        help='Split gliders between instances with leases stored in Mongo '
+             'instead of by hash. Leases are renewed while an instance runs. '
+             'Leases of a dead instance expire after this many seconds and '
+             'are taken over by the others.',
+        type=float,
+        default=os.environ.get('GDAM_LEASE_SECONDS')
+    )
+    parser.add_argument(
+        "--worker_id",
+        help='Name of this instance in the lease collection. '
+             'Default is "<hostname>:<pid>".',
+        default=os.environ.get('GDAM_WORKER_ID')
+    )
     parser.add_argument(
         "--daemonize",
         help="To daemonize or not to daemonize",
@@ -85,6 +147,23 @@ def main():
                      "GDB_DATA_DIR environmental variable")
         sys.exit(parser.print_usage())
 
+    # Imported here so --help doesn't pay for zmq, pymongo and friends
+    from gdam.processor import GliderFileProcessor
+    from gdam.sharding import StaticPartitioner, LeasePartitioner
+
+    partitioner = None
+    if args.lease_seconds:
+        partitioner = LeasePartitioner(
+            args.mongo_url,
+            worker_id=args.worker_id,
+            lease_seconds=float(args.lease_seconds)
+        )
+    elif args.worker_count > 1:
+        partitioner = StaticPartitioner(args.worker_index, args.worker_count)
+
+    if partitioner is not None:
+        partitioner.start()
+
     wm = WatchManager()
     mask = IN_MOVED_TO | IN_CLOSE_WRITE
     wm.add_watch(
@@ -96,7 +175,13 @@ def main():
 
     processor = GliderFileProcessor(
         zmq_url=args.zmq_url,
-        mongo_url=args.mongo_url
+        mongo_url=args.mongo_url,
+        batch_size=args.batch_size,
+        max_rss=int(float(args.max_rss) * 1024 * 1024) if args.max_rss else None,
+        bucket_size=int(args.bucket_size) if args.bucket_size else None,
+        bucket_seconds=float(args.bucket_seconds) if args.bucket_seconds else None,
+        config_path=args.configs,
+        partitioner=partitioner
     )
     notifier = Notifier(wm, processor)
 
@@ -110,6 +195,9 @@ def main():
     except NotifierError:
         logger.exception('Unable to start notifier loop')
         return 1
+    finally:
+        if partitioner is not None:
+            partitioner.release()
 
     logger.info("GDAM Exited Successfully")
     return 0
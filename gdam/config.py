@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+# Locates the per glider configuration folders shared by gdam-cli
+# (ingest.json) and gdam2nc (netCDF global and instrument attributes).
+
+import os
+
+
+def find_config_folder(config_path, glider_name, deployment_name):
+    """ Returns the configuration folder for a glider deployment or None """
+    config_folder_options = [
+        os.path.join(config_path, '{}__{}'.format(glider_name, deployment_name)),
+        os.path.join(config_path, '{}_{}'.format(glider_name, deployment_name)),
+        os.path.join(config_path, '{}-{}'.format(glider_name, deployment_name)),
+        os.path.join(config_path, glider_name, deployment_name),
+        os.path.join(config_path, glider_name),
+    ]
+    for cp in config_folder_options:
+        if os.path.isdir(cp):
+            return cp
+    return None
@@ -7,7 +7,6 @@ import tempfile
 import argparse
 from ftplib import FTP
 
-import netCDF4 as nc4
 from pyinotify import (
     WatchManager,
     Notifier,
@@ -16,13 +15,15 @@ from pyinotify import (
     IN_MOVED_TO
 )
 from pyinotify import ProcessEvent
-from compliance_checker.runner import ComplianceChecker, CheckSuite
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 def profile_compliance(filepath):
+    # Loading the checkers is slow, only pay for it once a file shows up
+    from compliance_checker.runner import ComplianceChecker, CheckSuite
+
     check_suite = CheckSuite()
     check_suite.load_all_available_checkers()
 
@@ -80,6 +81,9 @@ class GliderNc2FtpProcessor(ProcessEvent):
         return False
 
     def upload_file(self, event):
+        import netCDF4 as nc4
+
+        ftp = None
         try:
             ftp = FTP(self.ftp_url)
             ftp.login(self.ftp_user, self.ftp_pass)
@@ -107,7 +111,8 @@ class GliderNc2FtpProcessor(ProcessEvent):
             logger.error('Could not upload: {}. {}.'.format(event.pathname, e))
 
         finally:
-            ftp.quit()
+            if ftp is not None:
+                ftp.quit()
 
 
 def main():
@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+
+# Replays glider flight/science pairs into a GDAM watch directory to
+# simulate a surfacing burst across many virtual gliders, and reports
+# how long each stage of the pipeline took.
+#
+# Stages, per segment:
+# * wait: pair complete in the watch directory -> gdam-cli starts on it
+# * ingest: gdam-cli starts on it -> ZMQ message published
+# * publish: pair complete -> ZMQ message received
+# * netcdf: pair complete -> first netCDF file in the gdam2nc output
+# * upload: netCDF file written -> same file in the FTP directory
+# * total: pair complete -> netCDF file in the FTP directory
+#
+# gdam2nc does not say which netCDF files came from which segment. Each
+# virtual glider gets a copy of the source config with its own glider name
+# so its netCDF files carry that name. A new netCDF file is credited to the
+# last segment published for the glider in its path. Files rewritten in
+# place, eg. by synthetic segments that repeat the source data, count as
+# new writes.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from datetime import datetime
+
+from gdam.storage import FLIGHT_SCIENCE_PAIRS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+EPOCH = datetime.utcfromtimestamp(0)
+
+STAGES = ['wait', 'ingest', 'publish', 'netcdf', 'upload', 'total']
+
+
+def find_pairs(source):
+    """ Returns sorted (file base, pair) tuples for complete pairs in a folder """
+    names = set(os.listdir(source))
+    pairs = []
+    for name in sorted(names):
+        for pair in FLIGHT_SCIENCE_PAIRS:
+            if name.endswith('.' + pair[0]) and name[:-3] + pair[1] in names:
+                pairs.append((name[:-3], pair))
+    return pairs
+
+
+def schedule(pairs, gliders, segments):
+    """ Yields (glider, source base, target base, pair) for every copy
+
+    Each virtual glider gets every source pair under its own name. The
+    source pairs are then reused under new segment numbers until each
+    glider has `segments` pairs.
+    """
+    count = max(segments or 0, len(pairs))
+    for i in range(count):
+        base, pair = pairs[i % len(pairs)]
+        for glider in gliders:
+            parts = base.rsplit('-', 4)
+            if i < len(pairs) and len(parts) == 5:
+                # Keep the <year>-<day>-<mission>-<segment> part of the name
+                target = '-'.join([glider] + parts[1:])
+            else:
+                target = '{}-2099-001-0-{}.'.format(glider, i)
+            yield glider, base, target, pair
+
+
+def parse_isoformat(value):
+    # datetime.isoformat() leaves out the microseconds when they are zero
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S'
+    return datetime.strptime(value, fmt)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def list_files(path, extension):
+    """ Returns {relative path: modification time} for matching files """
+    found = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith(extension):
+                full_path = os.path.join(root, name)
+                try:
+                    found[os.path.relpath(full_path, path)] = os.path.getmtime(full_path)
+                except OSError:
+                    # Removed while we were looking
+                    pass
+    return found
+
+
+def changed_files(path, extension, known):
+    """ Returns the files that are new or rewritten since `known` and updates it """
+    changed = []
+    for name, mtime in list_files(path, extension).items():
+        if known.get(name) != mtime:
+            known[name] = mtime
+            changed.append(name)
+    return changed
+
+
+class LoadGenerator(object):
+    """ Copies pairs into the watch directory and times each stage """
+
+    def __init__(self, source, data_path, gliders, rate, segments=None,
+                 configs=None, source_config=None, output=None, ftp_dir=None,
+                 upload_grace=30.0):
+        self.source = source
+        self.data_path = data_path
+        self.gliders = gliders
+        self.rate = rate
+        self.segments = segments
+        self.configs = configs
+        self.source_config = source_config
+        self.output = output
+        self.ftp_dir = ftp_dir
+        self.upload_grace = upload_grace
+
+        # (glider, flight file) -> {stage: timestamp}
+        self.segments_seen = {}
+        # glider -> (glider, flight file) of its last published segment
+        self.last_published = {}
+        # [(file name, written, segment key or None)]
+        self.netcdf = []
+        # file name -> [upload times]
+        self.uploaded = {}
+        # Last time a pair was dropped or a netCDF file was written or uploaded
+        self.last_change = None
+
+    def setup(self):
+        for glider in self.gliders:
+            os.makedirs(os.path.join(self.data_path, glider), exist_ok=True)
+            if self.configs and self.source_config:
+                config_folder = os.path.join(self.configs, glider)
+                if not os.path.isdir(config_folder):
+                    shutil.copytree(self.source_config, config_folder)
+                    self.rename_glider(config_folder, glider)
+
+        # Anything already there is not ours
+        self.known_netcdf = list_files(self.output, '.nc') if self.output else {}
+        self.known_uploads = list_files(self.ftp_dir, '.nc') if self.ftp_dir else {}
+
+    def rename_glider(self, config_folder, glider):
+        """ Names the glider in a copied config so its netCDF files carry the name """
+        deployment_file = os.path.join(config_folder, 'deployment.json')
+        if not os.path.isfile(deployment_file):
+            return
+
+        with open(deployment_file, 'rt') as f:
+            deployment = json.load(f)
+        deployment['glider'] = glider
+        with open(deployment_file, 'wt') as f:
+            json.dump(deployment, f, indent=4)
+
+    def glider_for(self, path):
+        """ The virtual glider named in a path, preferring the longest match """
+        matches = [g for g in self.gliders if g in path]
+        return max(matches, key=len) if matches else None
+
+    def drop(self, glider, base, target, pair):
+        """ Moves a pair into the watch directory like a glider surfacing """
+        folder = os.path.join(self.data_path, glider)
+        for extension in pair:
+            hidden = os.path.join(folder, '.' + target + extension)
+            shutil.copyfile(os.path.join(self.source, base + extension), hidden)
+            os.rename(hidden, os.path.join(folder, target + extension))
+
+        self.segments_seen[(glider, target + pair[0])] = {'arrived': time.time()}
+        self.last_change = time.time()
+
+    def on_message(self, message, received):
+        key = (message['glider'], message['flight_file'])
+        segment = self.segments_seen.get(key)
+        if segment is None:
+            return
+
+        segment['published'] = received
+        if message.get('processed'):
+            segment['processed'] = (parse_isoformat(message['processed']) - EPOCH).total_seconds()
+        self.last_published[message['glider']] = key
+
+    def poll_files(self):
+        now = time.time()
+        if self.output:
+            for path in changed_files(self.output, '.nc', self.known_netcdf):
+                self.last_change = now
+                key = self.last_published.get(self.glider_for(path))
+                self.netcdf.append((os.path.basename(path), now, key))
+                segment = self.segments_seen.get(key)
+                if segment is not None and 'netcdf' not in segment:
+                    segment['netcdf'] = now
+
+        if self.ftp_dir:
+            for path in changed_files(self.ftp_dir, '.nc', self.known_uploads):
+                self.last_change = now
+                self.uploaded.setdefault(os.path.basename(path), []).append(now)
+
+    def upload_after(self, name, written):
+        """ Time of the first upload of a file at or after it was written """
+        for uploaded in self.uploaded.get(name, []):
+            if uploaded >= written:
+                return uploaded
+        return None
+
+    def not_uploaded(self):
+        """ netCDF writes that have not shown up in the FTP directory """
+        return [n for n in self.netcdf if self.upload_after(n[0], n[1]) is None]
+
+    def done(self, now=None):
+        now = now or time.time()
+        for segment in self.segments_seen.values():
+            if 'published' not in segment:
+                return False
+        if self.ftp_dir and self.not_uploaded():
+            # nc2ftp never uploads files that fail the compliance check, stop
+            # waiting for them once nothing has changed for a while
+            return self.last_change is not None and now - self.last_change >= self.upload_grace
+        return True
+
+    def latencies(self):
+        stages = {stage: [] for stage in STAGES}
+        for segment in self.segments_seen.values():
+            arrived = segment['arrived']
+            if 'processed' in segment:
+                stages['wait'].append(segment['processed'] - arrived)
+                if 'published' in segment:
+                    stages['ingest'].append(segment['published'] - segment['processed'])
+            if 'published' in segment:
+                stages['publish'].append(segment['published'] - arrived)
+            if 'netcdf' in segment:
+                stages['netcdf'].append(segment['netcdf'] - arrived)
+
+        for name, written, key in self.netcdf:
+            uploaded = self.upload_after(name, written)
+            if uploaded is None:
+                continue
+            stages['upload'].append(uploaded - written)
+            segment = self.segments_seen.get(key)
+            if segment is not None:
+                stages['total'].append(uploaded - segment['arrived'])
+
+        return stages
+
+    def report(self):
+        lines = ['{:<8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format(
+            'stage', 'count', 'min', 'median', 'p95', 'max'
+        )]
+        latencies = self.latencies()
+        for stage in STAGES:
+            values = latencies[stage]
+            if not values:
+                lines.append('{:<8} {:>6}'.format(stage, 0))
+                continue
+            lines.append('{:<8} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                stage,
+                len(values),
+                min(values),
+                percentile(values, 50),
+                percentile(values, 95),
+                max(values)
+            ))
+        segments = self.segments_seen.values()
+        lines.append('{} segments dropped, {} never published, {} without a netCDF file'.format(
+            len(self.segments_seen),
+            len([s for s in segments if 'published' not in s]),
+            len([s for s in segments if 'netcdf' not in s]) if self.output else 'n/a'
+        ))
+        lines.append('{} netCDF files written, {} not matched to a segment'.format(
+            len(self.netcdf),
+            len([n for n in self.netcdf if n[2] is None])
+        ))
+        lines.append('{} uploads, {} netCDF files never uploaded'.format(
+            sum(len(u) for u in self.uploaded.values()),
+            len(self.not_uploaded()) if self.ftp_dir else 'n/a'
+        ))
+        return '\n'.join(lines)
+
+    def run(self, socket, timeout, poll=0.5):
+        import zmq
+
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+
+        pending = list(schedule(find_pairs(self.source), self.gliders, self.segments))
+        logger.info('Dropping {} pairs across {} gliders at {} pairs/s'.format(
+            len(pending),
+            len(self.gliders),
+            self.rate
+        ))
+
+        start = time.time()
+        next_poll = start
+        for i, copy in enumerate(pending):
+            # Hold back until this pair is due, handling messages meanwhile
+            due = start + i / self.rate
+            while True:
+                now = time.time()
+                if now >= due:
+                    break
+                self.receive(socket, poller, min(due - now, poll))
+                if now >= next_poll:
+                    self.poll_files()
+                    next_poll = now + poll
+            self.drop(*copy)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.receive(socket, poller, poll)
+            self.poll_files()
+            if self.done():
+                break
+        else:
+            logger.warning('Timed out waiting for the pipeline after {}s'.format(timeout))
+
+    def receive(self, socket, poller, wait):
+        events = dict(poller.poll(int(wait * 1000)))
+        while socket in events:
+            self.on_message(socket.recv_json(), time.time())
+            events = dict(poller.poll(0))
+
+
+def main():
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Replay glider flight/science pairs into a GDAM watch "
+                    "directory across many virtual gliders and report the "
+                    "latency of each stage of the pipeline."
+    )
+    parser.add_argument(
+        "-s",
+        "--source",
+        help="Folder with the flight/science pairs to replay, "
+             "eg. gdam-example/data/usf-bass",
+        required=True
+    )
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        help="Directory gdam-cli is watching",
+        default=os.environ.get('GDB_DATA_DIR')
+    )
+    parser.add_argument(
+        "--gliders",
+        help="Number of virtual gliders. Default is 10.",
+        type=int,
+        default=10
+    )
+    parser.add_argument(
+        "--prefix",
+        help="Name prefix for the virtual gliders. Default is 'loadgen'.",
+        default='loadgen'
+    )
+    parser.add_argument(
+        "--rate",
+        help="Pairs dropped per second across all gliders. Default is 5.",
+        type=float,
+        default=5.0
+    )
+    parser.add_argument(
+        "--segments",
+        help="Pairs per glider. Source pairs are reused under new segment "
+             "numbers past the number of pairs in --source. "
+             "Default is one of each source pair.",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "--zmq_url",
+        help='ZMQ URL(s) gdam-cli publishes on, comma separated. '
+             'Default is "tcp://127.0.0.1:44444".',
+        default=os.environ.get('ZMQ_URL', 'tcp://127.0.0.1:44444')
+    )
+    parser.add_argument(
+        "--configs",
+        help="gdam2nc configuration folder. A copy of --source_config is "
+             "made for every virtual glider.",
+        default=os.environ.get('GDAM2NC_CONFIG')
+    )
+    parser.add_argument(
+        "--source_config",
+        help="Configuration folder of the glider in --source"
+    )
+    parser.add_argument(
+        "--output",
+        help="gdam2nc output directory, to time the netCDF stage",
+        default=os.environ.get('GDAM2NC_OUTPUT')
+    )
+    parser.add_argument(
+        "--ftp_dir",
+        help="Directory the local FTP server stores uploads in, "
+             "to time the upload stage"
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Seconds to wait for the pipeline after the last pair is "
+             "dropped. Default is 300.",
+        type=float,
+        default=300.0
+    )
+    parser.add_argument(
+        "--upload_grace",
+        help="Stop waiting for netCDF files to be uploaded once nothing has "
+             "changed for this many seconds. nc2ftp skips files that fail "
+             "the compliance check. Default is 30.",
+        type=float,
+        default=30.0
+    )
+
+    args = parser.parse_args()
+
+    if not args.data_path:
+        logger.error("Please provide a --data_path agrument or set the "
+                     "GDB_DATA_DIR environmental variable")
+        sys.exit(parser.print_usage())
+
+    if args.rate <= 0:
+        logger.error("--rate must be greater than 0")
+        sys.exit(parser.print_usage())
+
+    import zmq
+
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    for zmq_url in args.zmq_url.split(','):
+        socket.connect(zmq_url.strip())
+    socket.setsockopt(zmq.SUBSCRIBE, b'')
+
+    generator = LoadGenerator(
+        source=args.source,
+        data_path=args.data_path,
+        gliders=['{}-{:02d}'.format(args.prefix, i) for i in range(args.gliders)],
+        rate=args.rate,
+        segments=args.segments,
+        configs=args.configs,
+        source_config=args.source_config,
+        output=args.output,
+        ftp_dir=args.ftp_dir,
+        upload_grace=args.upload_grace
+    )
+    generator.setup()
+
+    try:
+        generator.run(socket, args.timeout)
+    except KeyboardInterrupt:
+        pass
+
+    print(generator.report())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,7 +14,7 @@ import sys
 import argparse
 import subprocess
 
-import zmq
+from gdam.config import find_config_folder
 
 import logging
 logger = logging.getLogger(__name__)
@@ -47,18 +47,7 @@ def handle_message(message, config_path, output_path):
     glider_name = message['glider']
     deployment_name = message['deployment']
 
-    config_folder_options = [
-        os.path.join(config_path, '{}__{}'.format(glider_name, deployment_name)),
-        os.path.join(config_path, '{}_{}'.format(glider_name, deployment_name)),
-        os.path.join(config_path, '{}-{}'.format(glider_name, deployment_name)),
-        os.path.join(config_path, glider_name, deployment_name),
-        os.path.join(config_path, glider_name),
-    ]
-    config_folder = None
-    for cp in config_folder_options:
-        if os.path.isdir(cp):
-            config_folder = cp
-            break
+    config_folder = find_config_folder(config_path, glider_name, deployment_name)
     if config_folder is None:
         raise ValueError("No config folder found for Glider {} and Deployment {}".format(
             glider_name,
@@ -102,7 +91,8 @@ def main():
     )
     parser.add_argument(
         "--zmq_url",
-        help='Port to listen for ZMQ GDAM messages. '
+        help='Port to listen for ZMQ GDAM messages. Separate multiple '
+             'URLs with commas to listen to several gdam-cli instances. '
              'Default is "tcp://127.0.0.1:44444".',
         default=os.environ.get('ZMQ_URL', 'tcp://127.0.0.1:44444')
     )
@@ -140,9 +130,12 @@ def main():
                      "GDAM2NC_OUTPUT environmental variable")
         sys.exit(parser.print_usage())
 
+    import zmq
+
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
-    socket.connect(args.zmq_url)
+    for zmq_url in args.zmq_url.split(','):
+        socket.connect(zmq_url.strip())
     socket.setsockopt(zmq.SUBSCRIBE, b'')
 
     logger.info("Loading configuration from {}\nListening to {}\nSaving to {}".format(
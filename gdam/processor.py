@@ -15,20 +15,150 @@
 # Ocean Technology Group
 
 import os
+import json
+import math
+import resource
 from datetime import datetime
 
 import zmq
 import pymongo
+from pymongo.errors import BulkWriteError, DocumentTooLarge, DuplicateKeyError
 from pyinotify import ProcessEvent
 
-from gutils.gbdr import GliderBDReader, MergedGliderBDReader
+from gdam.config import find_config_folder
+from gdam.storage import (
+    FLIGHT_SCIENCE_PAIRS,
+    ColumnBucket,
+    collection_name
+)
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+PAGE_SIZE = resource.getpagesize()
+
+
+def current_rss():
+    """ Resident set size of this process in bytes """
+    try:
+        with open('/proc/self/statm', 'rt') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, OSError, IndexError, ValueError):
+        # Not on Linux, fall back to the peak RSS (reported in KB)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class IngestFilter(object):
+    """ Drops sensors from rows before they are inserted
+
+    Loaded from an `ingest.json` file in a glider's configuration folder:
+
+        {
+            "include": ["m_depth-m", "sci_water_temp-degc", ...],
+            "exclude": ["m_roll-rad", ...],
+            "drop_nan": true,
+            "downsample": {"m_heading-rad": 60}
+        }
+
+    `include` and `exclude` are lists of sensor names. `drop_nan` removes
+    NaN values from each row so columns that are never measured are never
+    stored. `downsample` maps a sensor name to the minimum number of
+    seconds between kept values of that sensor.
+
+    Rules run before the GPS fields are combined, so a stored location such
+    as `m_gps_lonlat-lonlat` is matched as its `m_gps_lon-lon` and
+    `m_gps_lat-lat` source fields. Either form can be used. Rows left with
+    nothing but `keep_fields` are not stored at all.
+    """
+
+    config_file = 'ingest.json'
+
+    # Always kept, the inserter depends on them
+    keep_fields = ('timestamp',)
+
+    def __init__(self, include=None, exclude=None, drop_nan=False, downsample=None):
+        self.include = set(self.source_fields(include)) if include else None
+        self.exclude = set(self.source_fields(exclude or []))
+        self.drop_nan = drop_nan
+        self.downsample = {
+            field: seconds
+            for name, seconds in (downsample or {}).items()
+            for field in self.source_fields([name])
+        }
+        self.last_kept = {}
+
+    @staticmethod
+    def source_fields(names):
+        """ Expands combined lonlat names into the fields they are built from """
+        for name in names:
+            if name.endswith('lonlat-lonlat'):
+                prefix = name[:-len('lonlat-lonlat')]
+                yield prefix + 'lon-lon'
+                yield prefix + 'lat-lat'
+            else:
+                yield name
+
+    @classmethod
+    def from_config_folder(cls, config_folder):
+        config_file = os.path.join(config_folder, cls.config_file)
+        if not os.path.isfile(config_file):
+            return None
+
+        with open(config_file, 'rt') as f:
+            config = json.load(f)
+
+        return cls(
+            include=config.get('include'),
+            exclude=config.get('exclude'),
+            drop_nan=config.get('drop_nan', False),
+            downsample=config.get('downsample')
+        )
+
+    def apply(self, data):
+        timestamp = data['timestamp']
+        for field in list(data.keys()):
+            if field in self.keep_fields:
+                continue
+
+            value = data[field]
+            if self.include is not None and field not in self.include:
+                del data[field]
+            elif field in self.exclude:
+                del data[field]
+            elif self.drop_nan and isinstance(value, float) and math.isnan(value):
+                del data[field]
+            elif field in self.downsample:
+                last = self.last_kept.get(field)
+                if last is not None and timestamp - last < self.downsample[field]:
+                    del data[field]
+                else:
+                    self.last_kept[field] = timestamp
+
+        return data
+
+    def is_empty(self, data):
+        """ True if nothing but the always kept fields is left in a row """
+        return all(field in self.keep_fields for field in data)
+
+
 class GliderPairInserter(object):
-    """ Inserts data from a pair of glider files into GDAM """
+    """ Inserts data from a pair of glider files into GDAM
+
+    Documents are buffered and written with bulk inserts of at most
+    `batch_size` documents. If `max_rss` (bytes) is set the buffer is
+    flushed early whenever the process has grown by more than that since
+    the segment started, so the reader is held back until the pending
+    documents have been written.
+
+    By default each row is stored as its own document. Setting
+    `bucket_size` (rows) and/or `bucket_seconds` stores rows in
+    column oriented bucket documents instead, see `gdam.storage`.
+    A bucket is only written once it is full, its time span is reached, its
+    estimated size reaches `max_bucket_bytes` or `finish` is called at the
+    end of the segment. The open bucket is not written early by `max_rss`,
+    `max_bucket_bytes` is what bounds its memory.
+    """
 
     remove_time_fields = (
         'm_present_time-timestamp',
@@ -37,31 +167,54 @@ class GliderPairInserter(object):
 
     gps_fields = ("m_gps_lon-lon", "m_lon-lon", "c_wpt_lon-lon")
 
-    def __init__(self, glider, deployment, pair, mongo_url, dbname=None):
+    # How often (in buffered rows) to sample the RSS
+    rss_check_interval = 64
+
+    # Well under the 16 MB Mongo document limit, wide dbd files can have
+    # thousands of sensors per row
+    max_bucket_bytes = 8 * 1024 * 1024
+
+    def __init__(self, glider, deployment, pair, mongo_url, dbname=None,
+                 batch_size=None, max_rss=None, bucket_size=None, bucket_seconds=None,
+                 ingest_filter=None):
         self.pair = pair
+        self.ingest_filter = ingest_filter
         self.start = datetime.utcnow()
         self.end = datetime.utcfromtimestamp(0)
         self.processed = datetime.utcnow()
 
+        self.batch_size = batch_size or 1000
+        self.max_rss = max_rss
+        self.buffer = []
+        self.rows = 0
+        self.inserted = 0
+        # The ceiling applies to what this segment adds, CPython rarely
+        # hands memory back so earlier segments would otherwise count too
+        self.base_rss = current_rss()
+        self.peak_rss = self.base_rss
+        self.over_ceiling = False
+
+        self.bucket_size = bucket_size
+        self.bucket_seconds = bucket_seconds
+        self.bucket = None
+
         dbname = dbname or 'GDAM'
         self.mongo_client = pymongo.MongoClient(mongo_url)
         self.db = self.mongo_client[dbname]
 
-        deployment = deployment or 'unknown'
-        self.collection_name = "{}.{}.{}{}".format(
+        self.collection_name = collection_name(
             glider,
             deployment,
-            pair[0],
-            pair[1]
+            pair,
+            buckets=bool(bucket_size or bucket_seconds)
         )
         self.collection = self.db[self.collection_name]
 
     def __find_GPS(self, data):
         for field in self.gps_fields:
-            if field in data:
-                gps_prefix = field[0:field.find('lon')]
-                lat_field = "%slat-lat" % gps_prefix
-
+            gps_prefix = field[0:field.find('lon')]
+            lat_field = "%slat-lat" % gps_prefix
+            if field in data and lat_field in data:
                 lon = data[field]
                 lat = data[lat_field]
                 del data[field]
@@ -99,10 +252,19 @@ class GliderPairInserter(object):
                               (flight_file, science_file))
 
     def insert_data(self, data):
+        # Drop any sensors we were configured not to store
+        if self.ingest_filter is not None:
+            data = self.ingest_filter.apply(data)
+
         # Setup the timestamp field for Mongo
         for field in self.remove_time_fields:
             if field in data:
                 del data[field]
+
+        # Every sensor in the row was filtered out
+        if self.ingest_filter is not None and self.ingest_filter.is_empty(data):
+            return
+
         data['timestamp'] = datetime.utcfromtimestamp(data['timestamp'])
 
         if data['timestamp'] < self.start:
@@ -113,13 +275,108 @@ class GliderPairInserter(object):
         # If available, setup the lat lon field for Mongo
         data = self.__find_GPS(data)
 
-        # Add the file_set_id to the document
-        data['file_set_id'] = self.file_set_id
-
+        if self.bucket_size or self.bucket_seconds:
+            self.insert_into_bucket(data)
+        else:
+            # Add the file_set_id to the document
+            data['file_set_id'] = self.file_set_id
+            self.buffer.append(data)
+
+        self.rows += 1
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif self.max_rss and self.rows % self.rss_check_interval == 0:
+            growth = self.sample_rss() - self.base_rss
+            if growth > self.max_rss:
+                logger.debug('RSS grew by {} over ceiling {}, flushing {} documents'.format(
+                    growth,
+                    self.max_rss,
+                    len(self.buffer)
+                ))
+                self.flush()
+                self.check_ceiling()
+
+    def check_ceiling(self):
+        """ Warns once per segment if flushing did not bring memory back down """
+        growth = self.sample_rss() - self.base_rss
+        if growth > self.max_rss and not self.over_ceiling:
+            logger.warning(
+                'RSS still {:.1f} MB above the start of {} after flushing, '
+                'over the {:.1f} MB ceiling'.format(
+                    growth / 1024.0 / 1024.0,
+                    self.collection_name,
+                    self.max_rss / 1024.0 / 1024.0
+                )
+            )
+        self.over_ceiling = growth > self.max_rss
+
+    def insert_into_bucket(self, data):
+        if self.bucket is not None:
+            full = self.bucket_size and self.bucket.count >= self.bucket_size
+            expired = (
+                self.bucket_seconds and
+                (data['timestamp'] - self.bucket.start).total_seconds() >= self.bucket_seconds
+            )
+            too_large = self.bucket.size >= self.max_bucket_bytes
+            if full or expired or too_large:
+                self.close_bucket()
+
+        if self.bucket is None:
+            self.bucket = ColumnBucket(self.file_set_id)
+        self.bucket.append(data)
+
+    def close_bucket(self):
+        if self.bucket is not None and self.bucket.count > 0:
+            self.buffer.append(self.bucket.document())
+        self.bucket = None
+
+    def sample_rss(self):
+        rss = current_rss()
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+        return rss
+
+    def finish(self):
+        """ Writes everything left over at the end of a segment """
+        self.close_bucket()
+        self.flush()
+
+    def flush(self):
+        # The open bucket is left alone so flushes don't cut it short
+        if not self.buffer:
+            return
+
+        self.sample_rss()
         try:
-            self.collection.insert(data)
+            result = self.collection.insert_many(self.buffer, ordered=False)
+            self.inserted += len(result.inserted_ids)
+        except BulkWriteError as e:
+            self.inserted += e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                logger.error('Error inserting {}: {}'.format(error.get('op'), error.get('errmsg')))
+        except DocumentTooLarge:
+            # Only the oversized documents should be lost, not the batch
+            self.insert_each()
         except BaseException:
-            logger.exception('Error inserting {}'.format(data))
+            logger.exception('Error inserting {} documents'.format(len(self.buffer)))
+        finally:
+            # Drop references so the documents can be freed before reading on
+            self.buffer = []
+
+    def insert_each(self):
+        for document in self.buffer:
+            try:
+                self.collection.insert_one(document)
+                self.inserted += 1
+            except DuplicateKeyError:
+                # Written by the bulk insert before it gave up
+                self.inserted += 1
+            except DocumentTooLarge:
+                logger.error('Dropped a document from {} over the Mongo size limit'.format(
+                    self.collection_name
+                ))
+            except BaseException:
+                logger.exception('Error inserting a document into {}'.format(self.collection_name))
 
     def update_file_timespan(self):
         self.file_collection.update(
@@ -133,30 +390,59 @@ class GliderPairInserter(object):
         )
 
 
-FLIGHT_SCIENCE_PAIRS = [('dbd', 'ebd'), ('sbd', 'tbd'), ('mbd', 'nbd')]
-
-
 class GliderFileProcessor(ProcessEvent):
 
-    def my_init(self, zmq_url, mongo_url):
+    def my_init(self, zmq_url, mongo_url, batch_size=None, max_rss=None,
+                bucket_size=None, bucket_seconds=None, config_path=None,
+                partitioner=None, dbname=None):
         self.zmq_url = zmq_url
         self.mongo_url = mongo_url
+        self.dbname = dbname or 'GDAM'
+        self.batch_size = batch_size
+        self.max_rss = max_rss
+        self.bucket_size = bucket_size
+        self.bucket_seconds = bucket_seconds
+        self.config_path = config_path
+
+        # Decides which gliders this instance processes, see gdam.sharding
+        self.partitioner = partitioner
 
         self.glider_data = {}
 
+        # Used to look up processed_files when taking over a glider
+        self.mongo_client = pymongo.MongoClient(mongo_url)
+        self.db = self.mongo_client[self.dbname]
+
         # Create ZMQ context and socket for publishing files
         context = zmq.Context()
         self.socket = context.socket(zmq.PUB)
         self.socket.bind(self.zmq_url)
 
     def process_segment_pair(self, glider, deployment, path, file_base, pair):
+        # gutils pulls in the whole scientific stack, load it on first use
+        from gutils.gbdr import GliderBDReader, MergedGliderBDReader
+
         segment_id = int(file_base[file_base.rfind('-') + 1:file_base.find('.')])
 
         flight_file = file_base + pair[0]
         science_file = file_base + pair[1]
 
+        ingest_filter = None
+        if self.config_path:
+            config_folder = find_config_folder(self.config_path, glider, deployment)
+            if config_folder is not None:
+                ingest_filter = IngestFilter.from_config_folder(config_folder)
+
         dupe = False
-        inserter = GliderPairInserter(glider, deployment, pair, self.mongo_url)
+        inserter = GliderPairInserter(
+            glider, deployment, pair, self.mongo_url,
+            dbname=self.dbname,
+            batch_size=self.batch_size,
+            max_rss=self.max_rss,
+            bucket_size=self.bucket_size,
+            bucket_seconds=self.bucket_seconds,
+            ingest_filter=ingest_filter
+        )
         try:
             inserter.insert_filenames(glider, deployment, flight_file, science_file)
         except LookupError:
@@ -171,17 +457,28 @@ class GliderFileProcessor(ProcessEvent):
         if dupe is False:
             for data in merged_reader:
                 inserter.insert_data(data)
+            inserter.finish()
             inserter.update_file_timespan()
+            logger.info('Inserted {} documents from {} & {}, peak RSS {:.1f} MB'.format(
+                inserter.inserted,
+                flight_file,
+                science_file,
+                inserter.peak_rss / 1024.0 / 1024.0
+            ))
         else:
             inserter = None
 
+        # Only the headers are needed past this point, let the readers go
+        headers = merged_reader.headers
+        del merged_reader, flight_reader, science_reader
+
         self.publish_segment_processed(
             glider, deployment, segment_id,
             path, flight_file, science_file,
-            merged_reader, inserter
+            headers, inserter
         )
 
-    def publish_segment_processed(self, glider, deployment, segment_id, path, flight_file, science_file, merged_reader, inserter):  # NOQA
+    def publish_segment_processed(self, glider, deployment, segment_id, path, flight_file, science_file, headers, inserter):  # NOQA
 
         logger.info(
             'Publishing glider {0} segment {1:d} data in {2} & {3}'.format(
@@ -202,7 +499,8 @@ class GliderFileProcessor(ProcessEvent):
             'glider': glider,
             'deployment': deployment,
             'segment': segment_id,
-            'headers': merged_reader.headers
+            'peak_rss': inserter.peak_rss if inserter else None,
+            'headers': headers
         }
         self.socket.send_json(message)
 
@@ -220,6 +518,11 @@ class GliderFileProcessor(ProcessEvent):
                 glider_deployment = ''
 
             glider_name = os.path.basename(event.path)
+            if self.partitioner is not None and not self.partitioner.owns(glider_name):
+                # Another instance handles this glider
+                self.glider_data.pop(glider_name, None)
+                return
+
             if glider_name not in self.glider_data:
                 self.glider_data[glider_name] = {}
                 self.glider_data[glider_name]['path'] = event.path
@@ -227,25 +530,97 @@ class GliderFileProcessor(ProcessEvent):
 
             self.glider_data[glider_name]['files'].append(event.name)
 
-            fileType = event.name[-3:]
+            names = [event.name]
+            if self.partitioner is not None and self.partitioner.took_over(glider_name):
+                # Pick up any pairs the previous owner left unprocessed
+                names += self.unprocessed_files(glider_name, glider_deployment, event.path)
+
+            for name in names:
+                self.check_file(glider_name, glider_deployment, event.path, name)
+
+    def processed_pairs(self, glider, deployment):
+        """ Returns the (flight, science) file names that were fully inserted
+
+        A pair only gets its time span in processed_files once all of its
+        rows are written. A record without one was left by a worker that
+        died partway through the pair, its rows are removed so the pair can
+        be inserted again from the start.
+        """
+        deployment = deployment or 'unknown'
+        file_collection = self.db['{}.{}.processed_files'.format(glider, deployment)]
+
+        processed = set()
+        records = file_collection.find({}, {'flight_file': 1, 'science_file': 1, 'end_timestamp': 1})
+        for record in list(records):
+            if 'end_timestamp' in record:
+                processed.add((record['flight_file'], record['science_file']))
+            else:
+                self.discard_partial_pair(glider, deployment, file_collection, record)
+        return processed
 
-            # Check for matching pair
+    def discard_partial_pair(self, glider, deployment, file_collection, record):
+        """ Removes the rows and the processed_files record of an unfinished pair """
+        extension = record['flight_file'][-3:]
+        for pair in FLIGHT_SCIENCE_PAIRS:
+            if pair[0] != extension:
+                continue
+            # The pair was stored as rows or as buckets
+            for buckets in (False, True):
+                self.db[collection_name(glider, deployment, pair, buckets)].delete_many(
+                    {'file_set_id': record['_id']}
+                )
+        file_collection.delete_one({'_id': record['_id']})
+
+        logger.warning('Discarded partially inserted pair {} & {}'.format(
+            record['flight_file'],
+            record['science_file']
+        ))
+
+    def unprocessed_files(self, glider, deployment, path):
+        """ Tracks and returns the flight files of complete pairs on disk
+        that are not in processed_files yet """
+        processed = self.processed_pairs(glider, deployment)
+        files = self.glider_data[glider]['files']
+        on_disk = set(os.listdir(path))
+
+        names = []
+        for name in sorted(on_disk):
             for pair in FLIGHT_SCIENCE_PAIRS:
-                checkFile = None
-                if fileType == pair[0]:
-                    checkFile = event.name[:-3] + pair[1]
-                elif fileType == pair[1]:
-                    checkFile = event.name[:-3] + pair[0]
-
-                if checkFile in self.glider_data[glider_name]['files']:
-                    try:
-                        self.process_segment_pair(
-                            glider_name, glider_deployment, event.path, event.name[:-3], pair
-                        )
-                    except BaseException:
-                        logger.exception(
-                            'Error processing pair {}'.format(event.name[:-3])
-                        )
+                if not name.endswith('.' + pair[0]):
+                    continue
+                science_file = name[:-3] + pair[1]
+                if science_file not in on_disk or (name, science_file) in processed:
+                    continue
+
+                for f in (name, science_file):
+                    if f not in files:
+                        files.append(f)
+                names.append(name)
+
+        if names:
+            logger.info('Replaying {} unprocessed pairs for glider {}'.format(len(names), glider))
+        return names
+
+    def check_file(self, glider_name, glider_deployment, path, name):
+        fileType = name[-3:]
+
+        # Check for matching pair
+        for pair in FLIGHT_SCIENCE_PAIRS:
+            checkFile = None
+            if fileType == pair[0]:
+                checkFile = name[:-3] + pair[1]
+            elif fileType == pair[1]:
+                checkFile = name[:-3] + pair[0]
+
+            if checkFile in self.glider_data[glider_name]['files']:
+                try:
+                    self.process_segment_pair(
+                        glider_name, glider_deployment, path, name[:-3], pair
+                    )
+                except BaseException:
+                    logger.exception(
+                        'Error processing pair {}'.format(name[:-3])
+                    )
 
     def valid_extension(self, name):
         extension = name[name.rfind('.') + 1:]
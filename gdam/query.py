@@ -0,0 +1,421 @@
+#!/usr/bin/env python
+
+# Reads glider data inserted by gdam-cli back out of MongoDB.
+#
+# Data is stored in one collection per glider, deployment and file pair
+# named "<glider>.<deployment>.<pair>", eg. "usf-bass.unknown.sbdtbd",
+# plus a "<...>.buckets" collection if column buckets were used, next to
+# a "<glider>.<deployment>.processed_files" collection (see gdam.storage).
+# Time
+# window, bounding box, sensor and binning filters are pushed down to
+# Mongo as an aggregation pipeline and results are returned as an
+# iterator so they never have to be held in memory all at once.
+
+import os
+import sys
+import heapq
+import argparse
+from datetime import datetime
+from operator import itemgetter
+
+from gdam.storage import (
+    BUCKETS_SUFFIX,
+    FLIGHT_SCIENCE_PAIRS,
+    collection_name,
+    rows_from_bucket
+)
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+EPOCH = datetime.utcfromtimestamp(0)
+
+PROCESSED_FILES = 'processed_files'
+
+
+def bbox_geometry(bbox):
+    """ GeoJSON polygon for a (min lon, min lat, max lon, max lat) box """
+    minx, miny, maxx, maxy = bbox
+    return {
+        'type': 'Polygon',
+        'coordinates': [[
+            [minx, miny],
+            [maxx, miny],
+            [maxx, maxy],
+            [minx, maxy],
+            [minx, miny]
+        ]]
+    }
+
+
+def in_bbox(point, bbox):
+    if not point:
+        return False
+    lon, lat = point['coordinates']
+    return bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+
+class GliderQuery(object):
+    """ Queries the data gdam-cli inserted into Mongo """
+
+    location_field = 'm_gps_lonlat-lonlat'
+
+    def __init__(self, mongo_url, dbname=None):
+        # Imported here so the rest of the module can be used without pymongo
+        import pymongo
+
+        dbname = dbname or 'GDAM'
+        self.mongo_client = pymongo.MongoClient(mongo_url)
+        self.db = self.mongo_client[dbname]
+
+    def deployments(self):
+        """ Returns a sorted list of (glider, deployment) tuples """
+        found = set()
+        for name in self.db.list_collection_names():
+            parts = name.rsplit('.', 2)
+            if len(parts) == 3 and parts[2] == PROCESSED_FILES:
+                found.add((parts[0], parts[1]))
+        return sorted(found)
+
+    def pair_collections(self, glider, deployment=None):
+        """ Returns a list of the row and bucket collections of each file pair
+
+        Rows and buckets are stored in separate collections, a deployment
+        that changed storage options partway through has both.
+        """
+        existing = set(self.db.list_collection_names())
+        pairs = []
+        for pair in FLIGHT_SCIENCE_PAIRS:
+            names = [collection_name(glider, deployment, pair, buckets) for buckets in (False, True)]
+            collections = [self.db[name] for name in names if name in existing]
+            if collections:
+                pairs.append(collections)
+        return pairs
+
+    def data_collections(self, glider, deployment=None):
+        return [c for collections in self.pair_collections(glider, deployment) for c in collections]
+
+    def is_bucketed(self, collection):
+        """ True if the collection holds column bucket documents """
+        return collection.name.endswith('.' + BUCKETS_SUFFIX)
+
+    def create_indexes(self, glider, deployment=None):
+        """ Indexes the fields the query pipelines filter on """
+        import pymongo
+
+        for collection in self.data_collections(glider, deployment):
+            if self.is_bucketed(collection):
+                collection.create_index([('start', pymongo.ASCENDING), ('end', pymongo.ASCENDING)])
+            else:
+                collection.create_index([('timestamp', pymongo.ASCENDING)])
+                collection.create_index([(self.location_field, pymongo.GEOSPHERE)], sparse=True)
+
+    def row_pipeline(self, start=None, end=None, bbox=None, sensors=None, bin_seconds=None):
+        """ Aggregation pipeline over row documents """
+        match = {}
+        if start is not None or end is not None:
+            match['timestamp'] = {}
+            if start is not None:
+                match['timestamp']['$gte'] = start
+            if end is not None:
+                match['timestamp']['$lt'] = end
+        if bbox is not None:
+            match[self.location_field] = {
+                '$geoWithin': {'$geometry': bbox_geometry(bbox)}
+            }
+
+        pipeline = []
+        if match:
+            pipeline.append({'$match': match})
+
+        if bin_seconds:
+            if not sensors:
+                raise ValueError('Binning requires a list of sensors to average')
+
+            # Subtracting two dates gives milliseconds
+            millis = {'$subtract': ['$timestamp', EPOCH]}
+            bin_millis = int(bin_seconds * 1000)
+            group = {
+                '_id': {'$subtract': [millis, {'$mod': [millis, bin_millis]}]},
+                'count': {'$sum': 1}
+            }
+            for sensor in sensors:
+                group[sensor] = {'$avg': '${}'.format(sensor)}
+
+            projection = {'_id': 0, 'count': 1, 'timestamp': {'$add': [EPOCH, '$_id']}}
+            projection.update({sensor: 1 for sensor in sensors})
+
+            pipeline += [
+                {'$group': group},
+                {'$sort': {'_id': 1}},
+                {'$project': projection}
+            ]
+        else:
+            pipeline.append({'$sort': {'timestamp': 1}})
+            if sensors:
+                projection = {'timestamp': 1, 'file_set_id': 1, self.location_field: 1}
+                projection.update({sensor: 1 for sensor in sensors})
+                pipeline.append({'$project': projection})
+
+        return pipeline
+
+    def bucket_pipeline(self, start=None, end=None, sensors=None):
+        """ Aggregation pipeline over column bucket documents """
+        match = {}
+        if start is not None:
+            match['end'] = {'$gte': start}
+        if end is not None:
+            match['start'] = {'$lt': end}
+
+        pipeline = []
+        if match:
+            pipeline.append({'$match': match})
+        pipeline.append({'$sort': {'start': 1}})
+
+        if sensors:
+            projection = {
+                'file_set_id': 1,
+                'count': 1,
+                'columns.timestamp': 1,
+                'columns.{}'.format(self.location_field): 1
+            }
+            projection.update({'columns.{}'.format(sensor): 1 for sensor in sensors})
+            pipeline.append({'$project': projection})
+
+        return pipeline
+
+    def rows(self, glider, deployment=None, start=None, end=None, bbox=None,
+             sensors=None, bin_seconds=None, batch_size=1000):
+        """ Yields rows for a glider deployment in time order per file pair
+
+        start and end are datetimes, bbox is a (min lon, min lat, max lon,
+        max lat) tuple matched against `location_field` and sensors is a
+        list of sensor names to return. bin_seconds averages the sensors
+        into time bins and is only supported for row documents.
+        """
+        for collections in self.pair_collections(glider, deployment):
+            streams = [
+                self.collection_rows(
+                    collection,
+                    start=start,
+                    end=end,
+                    bbox=bbox,
+                    sensors=sensors,
+                    bin_seconds=bin_seconds,
+                    batch_size=batch_size
+                )
+                for collection in collections
+            ]
+            # Both streams are sorted, interleave rows and buckets by time
+            for row in heapq.merge(*streams, key=itemgetter('timestamp')):
+                yield row
+
+    def collection_rows(self, collection, start=None, end=None, bbox=None,
+                        sensors=None, bin_seconds=None, batch_size=1000):
+        if self.is_bucketed(collection):
+            if bin_seconds:
+                raise ValueError('Binning is not supported for bucket collections')
+
+            cursor = collection.aggregate(
+                self.bucket_pipeline(start=start, end=end, sensors=sensors),
+                allowDiskUse=True,
+                batchSize=batch_size
+            )
+            # Buckets overlap the window, the rows still need filtering
+            for bucket in cursor:
+                for row in rows_from_bucket(bucket):
+                    if start is not None and row['timestamp'] < start:
+                        continue
+                    if end is not None and row['timestamp'] >= end:
+                        continue
+                    if bbox is not None and not in_bbox(row.get(self.location_field), bbox):
+                        continue
+                    yield row
+        else:
+            pipeline = self.row_pipeline(
+                start=start,
+                end=end,
+                bbox=bbox,
+                sensors=sensors,
+                bin_seconds=bin_seconds
+            )
+            for row in collection.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size):
+                yield row
+
+
+def plain(row):
+    """ Drops the Mongo _id and turns ObjectIds into strings """
+    from bson import ObjectId
+
+    return {
+        k: str(v) if isinstance(v, ObjectId) else v
+        for k, v in row.items()
+        if k != '_id'
+    }
+
+
+def chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(plain(row))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def json_chunks(rows, chunk_size=1000):
+    """ Yields JSON arrays of up to chunk_size rows """
+    from bson import json_util
+
+    for chunk in chunks(rows, chunk_size):
+        yield json_util.dumps(chunk, json_options=json_util.RELAXED_JSON_OPTIONS)
+
+
+def arrow_batches(rows, sensors, chunk_size=1000):
+    """ Yields pyarrow RecordBatches of up to chunk_size rows
+
+    Every batch has the same schema, a timestamp column followed by one
+    float column per sensor. Missing values are null.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ImportError('pyarrow is required for Arrow output')
+
+    schema = pa.schema(
+        [('timestamp', pa.timestamp('ms'))] +
+        [(sensor, pa.float64()) for sensor in sensors]
+    )
+    for chunk in chunks(rows, chunk_size):
+        yield pa.RecordBatch.from_arrays(
+            [
+                pa.array([row.get(field.name) for row in chunk], type=field.type)
+                for field in schema
+            ],
+            schema=schema
+        )
+
+
+def parse_time(value):
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        'Could not parse "{}", use YYYY-MM-DD[THH:MM[:SS]]'.format(value)
+    )
+
+
+def main():
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser(
+        description="Query glider data inserted into Mongo by gdam-cli and "
+                    "stream it to stdout as JSON or Arrow."
+    )
+    parser.add_argument(
+        "glider",
+        nargs='?',
+        help="Glider to query. Lists the available gliders and deployments "
+             "if not given."
+    )
+    parser.add_argument(
+        "--deployment",
+        help="Deployment to query. Default is 'unknown'.",
+        default=None
+    )
+    parser.add_argument(
+        "--mongo_url",
+        help='Mongo Database URL.  Can include authentication parameters. '
+             'Default is "mongodb://localhost:27017".',
+        default=os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+    )
+    parser.add_argument(
+        "--start",
+        help="Only return data at or after this UTC time (YYYY-MM-DD[THH:MM[:SS]])",
+        type=parse_time
+    )
+    parser.add_argument(
+        "--end",
+        help="Only return data before this UTC time (YYYY-MM-DD[THH:MM[:SS]])",
+        type=parse_time
+    )
+    parser.add_argument(
+        "--bbox",
+        help="Only return data inside this box",
+        nargs=4,
+        type=float,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT')
+    )
+    parser.add_argument(
+        "--sensors",
+        help="Comma separated list of sensors to return. Default is all sensors."
+    )
+    parser.add_argument(
+        "--bin_seconds",
+        help="Average the sensors into time bins of this many seconds",
+        type=float
+    )
+    parser.add_argument(
+        "--format",
+        help="Output format, 'json' (one JSON array per chunk and line) "
+             "or 'arrow' (Arrow IPC stream). Default is 'json'.",
+        choices=['json', 'arrow'],
+        default='json'
+    )
+    parser.add_argument(
+        "--chunk_size",
+        help="Number of rows per output chunk. Default is 1000.",
+        type=int,
+        default=1000
+    )
+
+    args = parser.parse_args()
+
+    if args.format == 'arrow' and not args.sensors:
+        logger.error("Arrow output needs a --sensors list")
+        sys.exit(parser.print_usage())
+
+    query = GliderQuery(args.mongo_url)
+
+    if not args.glider:
+        for glider, deployment in query.deployments():
+            print('{} {}'.format(glider, deployment))
+        return 0
+
+    rows = query.rows(
+        args.glider,
+        deployment=args.deployment,
+        start=args.start,
+        end=args.end,
+        bbox=args.bbox,
+        sensors=args.sensors.split(',') if args.sensors else None,
+        bin_seconds=args.bin_seconds,
+        batch_size=args.chunk_size
+    )
+
+    if args.format == 'arrow':
+        import pyarrow as pa
+        sensors = args.sensors.split(',')
+        writer = None
+        for batch in arrow_batches(rows, sensors, args.chunk_size):
+            if writer is None:
+                writer = pa.ipc.new_stream(sys.stdout.buffer, batch.schema)
+            writer.write_batch(batch)
+        if writer is not None:
+            writer.close()
+    else:
+        for chunk in json_chunks(rows, args.chunk_size):
+            sys.stdout.write(chunk)
+            sys.stdout.write('\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
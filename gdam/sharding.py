@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# Partitions gliders across multiple gdam-cli instances watching the
+# same data directory. Each instance only tracks and processes the
+# files of the gliders it owns.
+#
+# * StaticPartitioner: a fixed hash of the glider name picks the worker
+# * LeasePartitioner: workers take out expiring leases on gliders in
+#   Mongo and renew them on a timer while they are alive. If a worker
+#   dies its leases expire and the next worker to see data for those
+#   gliders takes them over.
+
+import os
+import zlib
+import socket
+import threading
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class StaticPartitioner(object):
+    """ Assigns each glider to one of `worker_count` workers by hash """
+
+    def __init__(self, worker_index, worker_count):
+        if not 0 <= worker_index < worker_count:
+            raise ValueError('Worker index {} is not in [0, {})'.format(
+                worker_index,
+                worker_count
+            ))
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+
+    def owns(self, glider):
+        # crc32 is stable across processes, unlike hash()
+        bucket = zlib.crc32(glider.encode('utf-8')) % self.worker_count
+        return bucket == self.worker_index
+
+    def took_over(self, glider):
+        # Ownership never moves between workers
+        return False
+
+    def start(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class LeasePartitioner(object):
+    """ Assigns gliders to workers with expiring leases stored in Mongo """
+
+    def __init__(self, mongo_url, worker_id=None, lease_seconds=300, dbname=None):
+        self.worker_id = worker_id or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lease_seconds = lease_seconds
+        self.lease = timedelta(seconds=lease_seconds)
+
+        # Gliders whose lease was taken over from another worker
+        self.taken_over = set()
+        self.stopped = threading.Event()
+        self.renewer = None
+
+        dbname = dbname or 'GDAM'
+        self.mongo_client = pymongo.MongoClient(mongo_url)
+        self.collection = self.mongo_client[dbname]['leases']
+
+    def owns(self, glider):
+        """ Takes out or renews the lease on a glider if it is free """
+        now = datetime.utcnow()
+        try:
+            before = self.collection.find_one_and_update(
+                {
+                    '_id': glider,
+                    '$or': [
+                        {'owner': self.worker_id},
+                        {'expires': {'$lt': now}}
+                    ]
+                },
+                {
+                    '$set': {
+                        'owner': self.worker_id,
+                        'expires': now + self.lease
+                    }
+                },
+                upsert=True,
+                return_document=pymongo.ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            # Another worker holds a live lease
+            return False
+
+        if before is not None and before['owner'] != self.worker_id:
+            logger.info('Took over glider {} from {}'.format(glider, before['owner']))
+            self.taken_over.add(glider)
+        return True
+
+    def took_over(self, glider):
+        """ True once after the lease on a glider was taken from another worker """
+        if glider in self.taken_over:
+            self.taken_over.discard(glider)
+            return True
+        return False
+
+    def renew(self):
+        """ Extends every lease this worker holds """
+        self.collection.update_many(
+            {'owner': self.worker_id},
+            {'$set': {'expires': datetime.utcnow() + self.lease}}
+        )
+
+    def start(self):
+        """ Renews the leases in the background until `release` is called
+
+        Gliders surface far less often than leases expire, so the leases
+        are kept alive for as long as this worker is running instead of
+        only when a new file shows up.
+        """
+        def renew_until_stopped():
+            while not self.stopped.wait(self.lease_seconds / 3.0):
+                try:
+                    self.renew()
+                except BaseException:
+                    logger.exception('Could not renew leases held by {}'.format(self.worker_id))
+
+        self.renewer = threading.Thread(target=renew_until_stopped, daemon=True)
+        self.renewer.start()
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+        # Expire rather than delete so the next owner knows to pick up
+        # anything this worker left unprocessed
+        self.collection.update_many(
+            {'owner': self.worker_id},
+            {'$set': {'expires': datetime.utcnow()}}
+        )
+        logger.info('Released leases held by {}'.format(self.worker_id))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Layout of the glider data gdam-cli stores in Mongo, shared by the
+# inserter and the readers. Kept free of the ingest dependencies so the
+# data can be read back without zmq or pyinotify.
+#
+# Data is stored in one collection per glider, deployment and file pair
+# named "<glider>.<deployment>.<pair>", eg. "usf-bass.unknown.sbdtbd".
+# Column bucket documents go into a separate "<...>.buckets" collection
+# next to it, so a deployment that changes storage options partway
+# through never mixes the two schemas in one collection.
+
+
+FLIGHT_SCIENCE_PAIRS = [('dbd', 'ebd'), ('sbd', 'tbd'), ('mbd', 'nbd')]
+
+BUCKETS_SUFFIX = 'buckets'
+
+
+def collection_name(glider, deployment, pair, buckets=False):
+    """ Name of the collection holding the rows or buckets of a glider file pair """
+    name = '{}.{}.{}{}'.format(glider, deployment or 'unknown', pair[0], pair[1])
+    if buckets:
+        name = '{}.{}'.format(name, BUCKETS_SUFFIX)
+    return name
+
+
+def bson_size(value):
+    """ Rough number of bytes a value takes up in a BSON document """
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 5
+    if isinstance(value, dict):
+        return 5 + sum(len(k) + 2 + bson_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 5 + sum(len(str(i)) + 2 + bson_size(v) for i, v in enumerate(value))
+    # Numbers and dates
+    return 8
+
+
+class ColumnBucket(object):
+    """ Collects consecutive rows into one column oriented document
+
+    Each sensor name is stored once per bucket and its values are kept in
+    an array aligned with the `timestamp` column. Missing values are None.
+    `size` keeps a running estimate of the BSON size of the document, every
+    column costs an array element per row even where it is None.
+    """
+
+    def __init__(self, file_set_id):
+        self.file_set_id = file_set_id
+        self.count = 0
+        self.columns = {}
+        self.size = 0
+
+    @property
+    def start(self):
+        return self.columns['timestamp'][0]
+
+    @property
+    def end(self):
+        return self.columns['timestamp'][-1]
+
+    def append(self, data):
+        # Type byte, array index and terminator of one element
+        element = len(str(self.count)) + 2
+
+        for field, value in data.items():
+            if field not in self.columns:
+                self.columns[field] = [None] * self.count
+                self.size += len(field) + 7 + self.count * element
+            self.columns[field].append(value)
+            self.size += bson_size(value)
+
+        self.count += 1
+        self.size += len(self.columns) * element
+        for values in self.columns.values():
+            if len(values) < self.count:
+                values.append(None)
+
+    def document(self):
+        return {
+            'file_set_id': self.file_set_id,
+            'start': self.start,
+            'end': self.end,
+            'count': self.count,
+            'columns': self.columns
+        }
+
+
+def rows_from_bucket(document):
+    """ Reconstructs the row documents stored in a bucket document """
+    columns = document['columns']
+    for i in range(document['count']):
+        row = {
+            field: values[i]
+            for field, values in columns.items()
+            if values[i] is not None
+        }
+        row['file_set_id'] = document['file_set_id']
+        yield row
@@ -33,7 +33,9 @@ setup(
         'console_scripts': [
             'gdam-cli=gdam.cli:main',
             'gdam2nc=gdam.nc:main',
-            'nc2ftp=gdam.ftp:main'
+            'nc2ftp=gdam.ftp:main',
+            'gdam-query=gdam.query:main',
+            'gdam-loadgen=gdam.loadgen:main'
         ],
     },
     classifiers=[
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+import sys
+import unittest
+import subprocess
+
+import logging
+logger = logging.getLogger()
+logger.setLevel(logging.DEBUG)
+logger.addHandler(logging.StreamHandler())
+
+
+HEAVY_MODULES = ['gutils', 'netCDF4', 'compliance_checker', 'pymongo', 'zmq']
+
+# Imports an entry point module and runs it with --help in a fresh
+# interpreter, then reports how long that took and which heavy modules
+# were loaded along the way.
+PROBE = '''
+import sys
+import time
+start = time.time()
+import {module} as m
+sys.argv = ['probe', '--help']
+try:
+    m.main()
+except SystemExit:
+    pass
+print('elapsed', time.time() - start)
+print('loaded', *[x for x in {heavy!r} if x in sys.modules])
+'''
+
+
+def probe(module, heavy=HEAVY_MODULES):
+    out = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, heavy=heavy)],
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True
+    ).stdout.splitlines()
+    elapsed = float(out[-2].split()[1])
+    loaded = out[-1].split()[1:]
+    logger.info('{} --help: {:.3f}s'.format(module, elapsed))
+    return elapsed, loaded
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_gdam_cli_help(self):
+        _, loaded = probe('gdam.cli')
+        assert loaded == []
+
+    def test_gdam2nc_help(self):
+        _, loaded = probe('gdam.nc')
+        assert loaded == []
+
+    def test_nc2ftp_help(self):
+        _, loaded = probe('gdam.ftp')
+        assert loaded == []
+
+    def test_gdam_query_help(self):
+        # Readers should not need the ingest stack either
+        _, loaded = probe('gdam.query', heavy=HEAVY_MODULES + ['bson', 'pyinotify'])
+        assert loaded == []
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from gdam.loadgen import LoadGenerator, find_pairs, schedule, percentile
+
+EXAMPLE_DATA = os.path.join(
+    os.path.dirname(__file__), '..', 'gdam-example', 'data', 'usf-bass'
+)
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_path)
+
+    def test_find_pairs(self):
+        pairs = find_pairs(EXAMPLE_DATA)
+        assert ('usf-bass-2014-048-1-2.', ('sbd', 'tbd')) in pairs
+        # Science files without a flight file are not pairs
+        assert ('usf-bass-2014-042-0-13.', ('sbd', 'tbd')) not in pairs
+
+    def test_schedule(self):
+        pairs = [('usf-bass-2014-048-1-2.', ('sbd', 'tbd'))]
+        copies = list(schedule(pairs, ['loadgen-00', 'loadgen-01'], 2))
+        assert copies == [
+            ('loadgen-00', 'usf-bass-2014-048-1-2.', 'loadgen-00-2014-048-1-2.', ('sbd', 'tbd')),
+            ('loadgen-01', 'usf-bass-2014-048-1-2.', 'loadgen-01-2014-048-1-2.', ('sbd', 'tbd')),
+            ('loadgen-00', 'usf-bass-2014-048-1-2.', 'loadgen-00-2099-001-0-1.', ('sbd', 'tbd')),
+            ('loadgen-01', 'usf-bass-2014-048-1-2.', 'loadgen-01-2099-001-0-1.', ('sbd', 'tbd')),
+        ]
+
+    def test_drop_and_latencies(self):
+        generator = LoadGenerator(EXAMPLE_DATA, self.data_path, ['loadgen-00'], rate=1)
+        generator.setup()
+        generator.drop('loadgen-00', 'usf-bass-2014-048-1-2.', 'loadgen-00-2014-048-1-2.', ('sbd', 'tbd'))
+        assert sorted(os.listdir(os.path.join(self.data_path, 'loadgen-00'))) == [
+            'loadgen-00-2014-048-1-2.sbd',
+            'loadgen-00-2014-048-1-2.tbd'
+        ]
+
+        segment = generator.segments_seen[('loadgen-00', 'loadgen-00-2014-048-1-2.sbd')]
+        segment['arrived'] = 100.0
+        generator.on_message({
+            'glider': 'loadgen-00',
+            'flight_file': 'loadgen-00-2014-048-1-2.sbd',
+            'processed': '1970-01-01T00:01:42'
+        }, 105.0)
+        assert generator.done() is True
+
+        stages = generator.latencies()
+        assert stages['wait'] == [2.0]
+        assert stages['ingest'] == [3.0]
+        assert stages['publish'] == [5.0]
+
+    def publish(self, generator, glider, flight_file, arrived):
+        generator.segments_seen[(glider, flight_file)] = {'arrived': arrived}
+        generator.on_message({'glider': glider, 'flight_file': flight_file}, arrived + 1)
+
+    def write(self, folder, name, mtime):
+        path = os.path.join(self.data_path, folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+
+    def test_netcdf_credited_to_its_own_glider(self):
+        gliders = ['loadgen-1', 'loadgen-10']
+        generator = LoadGenerator(
+            EXAMPLE_DATA, self.data_path, gliders, rate=1,
+            output=os.path.join(self.data_path, 'output'),
+            ftp_dir=os.path.join(self.data_path, 'ftp')
+        )
+        generator.setup()
+
+        self.publish(generator, 'loadgen-1', 'loadgen-1-2014-048-1-2.sbd', 100.0)
+        self.publish(generator, 'loadgen-10', 'loadgen-10-2014-048-1-2.sbd', 200.0)
+
+        # The first glider's file shows up after the second glider published
+        self.write('output/loadgen-1-20150407T1300', 'loadgen-1_20140218T142000Z_rt.nc', 1)
+        generator.poll_files()
+        assert generator.netcdf[0][0] == 'loadgen-1_20140218T142000Z_rt.nc'
+        assert generator.netcdf[0][2] == ('loadgen-1', 'loadgen-1-2014-048-1-2.sbd')
+        assert 'netcdf' not in generator.segments_seen[('loadgen-10', 'loadgen-10-2014-048-1-2.sbd')]
+        assert generator.done() is False
+
+        self.write('ftp/some-id', 'loadgen-1_20140218T142000Z_rt.nc', 1)
+        generator.poll_files()
+        assert generator.done() is True
+        assert len(generator.latencies()['total']) == 1
+
+    def test_rewritten_netcdf_counts_as_a_new_write(self):
+        generator = LoadGenerator(
+            EXAMPLE_DATA, self.data_path, ['loadgen-00'], rate=1,
+            output=os.path.join(self.data_path, 'output')
+        )
+        generator.setup()
+
+        self.publish(generator, 'loadgen-00', 'loadgen-00-2014-048-1-2.sbd', 100.0)
+        self.write('output', 'loadgen-00_20140218T142000Z_rt.nc', 1)
+        generator.poll_files()
+
+        # A synthetic segment repeating the same data rewrites the same file
+        self.publish(generator, 'loadgen-00', 'loadgen-00-2099-001-0-30.sbd', 200.0)
+        self.write('output', 'loadgen-00_20140218T142000Z_rt.nc', 2)
+        generator.poll_files()
+
+        assert [n[2][1] for n in generator.netcdf] == [
+            'loadgen-00-2014-048-1-2.sbd',
+            'loadgen-00-2099-001-0-30.sbd'
+        ]
+        assert 'without a netCDF file' in generator.report()
+
+    def test_files_that_are_never_uploaded_do_not_block(self):
+        generator = LoadGenerator(
+            EXAMPLE_DATA, self.data_path, ['loadgen-00'], rate=1,
+            output=os.path.join(self.data_path, 'output'),
+            ftp_dir=os.path.join(self.data_path, 'ftp'),
+            upload_grace=30
+        )
+        generator.setup()
+
+        # The file fails the compliance check so nc2ftp never uploads it
+        self.publish(generator, 'loadgen-00', 'loadgen-00-2014-048-1-2.sbd', 100.0)
+        self.write('output', 'loadgen-00_20140218T142000Z_rt.nc', 1)
+        generator.poll_files()
+
+        assert generator.done(now=generator.last_change + 10) is False
+        assert generator.done(now=generator.last_change + 30) is True
+        assert '1 netCDF files never uploaded' in generator.report()
+
+    def test_config_copies_are_renamed(self):
+        config_source = os.path.join(os.path.dirname(__file__), '..', 'gdam-example', 'config', 'usf-bass')
+        configs = os.path.join(self.data_path, 'config')
+        generator = LoadGenerator(
+            EXAMPLE_DATA, os.path.join(self.data_path, 'data'), ['loadgen-00'], rate=1,
+            configs=configs,
+            source_config=config_source
+        )
+        generator.setup()
+        with open(os.path.join(configs, 'loadgen-00', 'deployment.json')) as f:
+            assert json.load(f)['glider'] == 'loadgen-00'
+
+    def test_percentile(self):
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile([1, 2, 3, 4], 100) == 4
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+import os
+import shutil
+import itertools
+import tempfile
+import unittest
+from collections import defaultdict
+from unittest import mock
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError, DocumentTooLarge, DuplicateKeyError
+
+from gdam.processor import GliderFileProcessor, GliderPairInserter, IngestFilter
+from gdam.storage import ColumnBucket, rows_from_bucket
+
+
+def make_inserter(**kwargs):
+    """ A GliderPairInserter writing to a mocked collection """
+    with mock.patch('gdam.processor.pymongo.MongoClient'):
+        inserter = GliderPairInserter(
+            'usf-bass', 'dep1', ('sbd', 'tbd'), 'mongodb://localhost:27017', **kwargs
+        )
+    inserter.file_set_id = 'fileset'
+    inserter.collection = mock.MagicMock()
+    inserter.collection.insert_many.side_effect = \
+        lambda documents, ordered: mock.Mock(inserted_ids=list(range(len(documents))))
+    return inserter
+
+
+def inserted_batches(inserter):
+    return [c[0][0] for c in inserter.collection.insert_many.call_args_list]
+
+
+class TestColumnBucket(unittest.TestCase):
+
+    def test_bucket_round_trip(self):
+        rows = [
+            {'timestamp': datetime(2016, 6, 24, 18, 0, 0), 'm_depth-m': 1.5},
+            {'timestamp': datetime(2016, 6, 24, 18, 0, 4), 'sci_water_temp-degc': 20.1},
+            {
+                'timestamp': datetime(2016, 6, 24, 18, 0, 8),
+                'm_depth-m': 2.5,
+                'm_gps_lonlat-lonlat': {'type': 'Point', 'coordinates': [-82.9, 27.7]}
+            },
+        ]
+
+        bucket = ColumnBucket('fileset')
+        for row in rows:
+            bucket.append(dict(row))
+
+        document = bucket.document()
+        assert document['count'] == 3
+        assert document['start'] == rows[0]['timestamp']
+        assert document['end'] == rows[-1]['timestamp']
+        assert document['columns']['m_depth-m'] == [1.5, None, 2.5]
+        assert document['columns']['sci_water_temp-degc'] == [None, 20.1, None]
+
+        rebuilt = list(rows_from_bucket(document))
+        for row in rows:
+            row['file_set_id'] = 'fileset'
+        assert rebuilt == rows
+
+
+class TestIngestFilter(unittest.TestCase):
+
+    def test_include_exclude_and_nan(self):
+        f = IngestFilter(
+            include=['m_depth-m', 'm_roll-rad', 'sci_water_temp-degc'],
+            exclude=['m_roll-rad'],
+            drop_nan=True
+        )
+        row = f.apply({
+            'timestamp': 1000.0,
+            'm_depth-m': 1.5,
+            'm_roll-rad': 0.1,
+            'm_pitch-rad': 0.2,
+            'sci_water_temp-degc': float('nan')
+        })
+        assert row == {'timestamp': 1000.0, 'm_depth-m': 1.5}
+
+    def test_downsample(self):
+        f = IngestFilter(downsample={'m_heading-rad': 10})
+        kept = [
+            'm_heading-rad' in f.apply({'timestamp': t, 'm_heading-rad': 1.0})
+            for t in range(0, 25, 4)
+        ]
+        assert kept == [True, False, False, True, False, False, True]
+
+    def test_lonlat_names_match_their_source_fields(self):
+        row = {'timestamp': 1000.0, 'm_gps_lon-lon': -82.9, 'm_gps_lat-lat': 27.7, 'm_lon-lon': -82.8}
+        assert IngestFilter(include=['m_gps_lonlat-lonlat']).apply(dict(row)) == {
+            'timestamp': 1000.0, 'm_gps_lon-lon': -82.9, 'm_gps_lat-lat': 27.7
+        }
+        assert IngestFilter(include=['m_gps_lon-lon', 'm_gps_lat-lat']).apply(dict(row)) == {
+            'timestamp': 1000.0, 'm_gps_lon-lon': -82.9, 'm_gps_lat-lat': 27.7
+        }
+        assert IngestFilter(exclude=['m_gps_lonlat-lonlat']).apply(dict(row)) == {
+            'timestamp': 1000.0, 'm_lon-lon': -82.8
+        }
+
+
+class TestGliderPairInserter(unittest.TestCase):
+
+    def test_batch_flushing(self):
+        inserter = make_inserter(batch_size=4)
+        for t in range(10):
+            inserter.insert_data({'timestamp': 1000.0 + t, 'm_depth-m': float(t)})
+        assert [len(b) for b in inserted_batches(inserter)] == [4, 4]
+
+        inserter.finish()
+        assert [len(b) for b in inserted_batches(inserter)] == [4, 4, 2]
+        assert inserter.inserted == 10
+        assert inserter.buffer == []
+
+    def test_bulk_write_error_counts_inserted(self):
+        inserter = make_inserter(batch_size=5)
+        inserter.collection.insert_many.side_effect = BulkWriteError({
+            'nInserted': 3,
+            'writeErrors': [{'op': {}, 'errmsg': 'duplicate'}] * 2
+        })
+        for t in range(5):
+            inserter.insert_data({'timestamp': 1000.0 + t})
+        assert inserter.inserted == 3
+        assert inserter.buffer == []
+
+    def test_filtered_rows(self):
+        inserter = make_inserter(
+            batch_size=1000,
+            ingest_filter=IngestFilter(include=['m_depth-m', 'm_gps_lonlat-lonlat'])
+        )
+        inserter.insert_data({'timestamp': 1000.0, 'm_roll-rad': 0.1, 'm_present_time-timestamp': 1000.0})
+        inserter.insert_data({'timestamp': 1004.0, 'm_depth-m': 1.5, 'm_roll-rad': 0.1})
+        inserter.insert_data({'timestamp': 1008.0, 'm_gps_lon-lon': -82.9, 'm_gps_lat-lat': 27.7})
+        inserter.finish()
+
+        # Rows with only a timestamp left are not stored, GPS is kept
+        documents = inserted_batches(inserter)[0]
+        assert len(documents) == 2
+        assert documents[0]['m_depth-m'] == 1.5
+        assert documents[1]['m_gps_lonlat-lonlat'] == {'type': 'Point', 'coordinates': [-82.9, 27.7]}
+
+    def test_memory_ceiling_is_relative_to_segment_start(self):
+        # A process that is already large does not trip the ceiling
+        with mock.patch('gdam.processor.current_rss', return_value=900):
+            inserter = make_inserter(batch_size=1000, max_rss=100)
+            for t in range(inserter.rss_check_interval):
+                inserter.insert_data({'timestamp': 1000.0 + t})
+        assert inserted_batches(inserter) == []
+
+        # Growing past it during the segment flushes early
+        with mock.patch('gdam.processor.current_rss', return_value=1100):
+            for t in range(inserter.rss_check_interval):
+                inserter.insert_data({'timestamp': 2000.0 + t})
+        assert [len(b) for b in inserted_batches(inserter)] == [2 * inserter.rss_check_interval]
+        assert inserter.over_ceiling is True
+        assert inserter.peak_rss == 1100
+
+    def test_buckets_have_their_own_collection(self):
+        assert make_inserter().collection_name == 'usf-bass.dep1.sbdtbd'
+        assert make_inserter(bucket_size=5).collection_name == 'usf-bass.dep1.sbdtbd.buckets'
+
+    def test_bucket_boundaries_survive_flushes(self):
+        inserter = make_inserter(batch_size=2, bucket_size=5)
+        for t in range(23):
+            inserter.insert_data({'timestamp': 1000.0 + t, 'm_depth-m': float(t)})
+
+        # Two full buckets per write, the open bucket is never cut short
+        assert [[d['count'] for d in b] for b in inserted_batches(inserter)] == [[5, 5], [5, 5]]
+
+        inserter.finish()
+        buckets = [d for b in inserted_batches(inserter) for d in b]
+        assert [d['count'] for d in buckets] == [5, 5, 5, 5, 3]
+        assert inserter.inserted == 5
+        rows = [row for d in buckets for row in rows_from_bucket(d)]
+        assert [row['m_depth-m'] for row in rows] == [float(t) for t in range(23)]
+
+    def test_bucket_seconds(self):
+        inserter = make_inserter(batch_size=1, bucket_seconds=60)
+        for t in range(0, 300, 4):
+            inserter.insert_data({'timestamp': 1000.0 + t})
+        inserter.finish()
+
+        spans = [
+            (d['end'] - d['start']).total_seconds()
+            for b in inserted_batches(inserter) for d in b
+        ]
+        assert spans == [56.0, 56.0, 56.0, 56.0, 56.0]
+
+
+    def test_buckets_are_capped_by_size(self):
+        inserter = make_inserter(batch_size=1000, bucket_seconds=3600)
+        inserter.max_bucket_bytes = 4096
+        for t in range(100):
+            row = {'timestamp': 1000.0 + t}
+            row.update({'sensor_{}-nodim'.format(i): float(i) for i in range(20)})
+            inserter.insert_data(row)
+        inserter.finish()
+
+        buckets = inserted_batches(inserter)[0]
+        assert len(buckets) > 1
+        assert sum(d['count'] for d in buckets) == 100
+        # Closed as soon as they pass the cap, so they overshoot by one row at most
+        assert all(d['count'] <= buckets[0]['count'] for d in buckets)
+        assert buckets[0]['count'] < 20
+
+    def test_oversized_document_only_loses_itself(self):
+        inserter = make_inserter(batch_size=4)
+        inserter.collection.insert_many.side_effect = DocumentTooLarge()
+
+        def insert_one(document):
+            if document['m_depth-m'] == 1.0:
+                raise DuplicateKeyError('written before the bulk insert failed')
+            if document['m_depth-m'] == 2.0:
+                raise DocumentTooLarge()
+        inserter.collection.insert_one.side_effect = insert_one
+
+        for t in range(4):
+            inserter.insert_data({'timestamp': 1000.0 + t, 'm_depth-m': float(t)})
+        assert inserter.collection.insert_one.call_count == 4
+        assert inserter.inserted == 3
+        assert inserter.buffer == []
+
+
+class TestGliderFileProcessor(unittest.TestCase):
+
+    def test_peak_rss_published(self):
+        p = GliderFileProcessor.__new__(GliderFileProcessor)
+        p.socket = mock.Mock()
+        p.glider_data = {'usf-bass': {'files': ['a-1.sbd', 'a-1.tbd']}}
+
+        inserter = make_inserter()
+        inserter.peak_rss = 12345
+        p.publish_segment_processed(
+            'usf-bass', '', 1, '/data/usf-bass', 'a-1.sbd', 'a-1.tbd', {}, inserter
+        )
+        message = p.socket.send_json.call_args[0][0]
+        assert message['peak_rss'] == 12345
+        assert p.glider_data['usf-bass']['files'] == []
+
+
+class FakePartitioner(object):
+
+    def __init__(self, owner=True, took_over=False):
+        self.owner = owner
+        self.taken_over = took_over
+
+    def owns(self, glider):
+        return self.owner
+
+    def took_over(self, glider):
+        taken_over, self.taken_over = self.taken_over, False
+        return taken_over
+
+
+class Event(object):
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+
+class TestPartitionedProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'usf-bass')
+        os.makedirs(self.path)
+
+        self.processor = GliderFileProcessor.__new__(GliderFileProcessor)
+        self.processor.glider_data = {}
+        self.processed = []
+
+        def process_segment_pair(glider, deployment, path, file_base, pair):
+            self.processed.append(file_base)
+            for extension in pair:
+                self.processor.glider_data[glider]['files'].remove(file_base + extension)
+
+        self.processor.process_segment_pair = process_segment_pair
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def arrive(self, name):
+        open(os.path.join(self.path, name), 'w').close()
+        self.processor.check_for_pair(Event(self.path, name))
+
+    def test_files_of_other_gliders_are_not_tracked(self):
+        self.processor.partitioner = FakePartitioner(owner=False)
+        for name in ['a-1.sbd', 'a-1.tbd', 'a-2.sbd']:
+            self.arrive(name)
+        assert self.processed == []
+        assert self.processor.glider_data == {}
+
+    def test_takeover_only_replays_unprocessed_pairs(self):
+        # Pairs 1 to 3 arrived while another instance owned the glider,
+        # it processed 1 and 2 before it died
+        self.processor.partitioner = FakePartitioner(owner=False)
+        for i in (1, 2, 3):
+            self.arrive('a-{}.sbd'.format(i))
+            self.arrive('a-{}.tbd'.format(i))
+        self.arrive('a-4.sbd')
+
+        self.processor.partitioner = FakePartitioner(owner=True, took_over=True)
+        self.processor.processed_pairs = mock.Mock(return_value={
+            ('a-1.sbd', 'a-1.tbd'),
+            ('a-2.sbd', 'a-2.tbd')
+        })
+        self.arrive('a-4.tbd')
+
+        assert sorted(self.processed) == ['a-3.', 'a-4.']
+        assert self.processor.glider_data['usf-bass']['files'] == []
+
+    def test_no_replay_without_takeover(self):
+        self.processor.partitioner = FakePartitioner(owner=True)
+        self.processor.processed_pairs = mock.Mock(return_value=set())
+        open(os.path.join(self.path, 'a-1.sbd'), 'w').close()
+        open(os.path.join(self.path, 'a-1.tbd'), 'w').close()
+
+        self.arrive('a-2.sbd')
+        self.arrive('a-2.tbd')
+        assert self.processed == ['a-2.']
+        assert self.processor.processed_pairs.called is False
+
+
+class FakeCursor(list):
+
+    def count(self):
+        return len(self)
+
+
+class FakeCollection(object):
+    """ Just enough of a pymongo collection to run a segment through """
+
+    def __init__(self):
+        self.documents = []
+        self.ids = itertools.count(1)
+
+    def matches(self, document, query):
+        return all(document.get(k) == v for k, v in query.items())
+
+    def find(self, query=None, projection=None):
+        return FakeCursor(d for d in self.documents if self.matches(d, query or {}))
+
+    def insert(self, document):
+        document['_id'] = next(self.ids)
+        self.documents.append(document)
+        return document['_id']
+
+    def insert_many(self, documents, ordered=True):
+        return mock.Mock(inserted_ids=[self.insert(d) for d in documents])
+
+    def update(self, query, update):
+        for document in self.find(query):
+            document.update(update['$set'])
+
+    def delete_many(self, query):
+        self.documents = [d for d in self.documents if not self.matches(d, query)]
+
+    delete_one = delete_many
+
+
+class WorkerDied(Exception):
+    pass
+
+
+class FakeReader(object):
+    """ Yields 12 rows for a segment, or dies after 6 if it is in `dies` """
+
+    dies = set()
+
+    def __init__(self, flight_reader, science_reader):
+        self.path = flight_reader
+        self.headers = {}
+
+    def __iter__(self):
+        for t in range(12):
+            if t == 6 and os.path.basename(self.path) in self.dies:
+                raise WorkerDied()
+            yield {'timestamp': 1000.0 + t, 'm_depth-m': float(t)}
+
+
+class TestTakeoverAfterCrash(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'usf-bass')
+        os.makedirs(self.path)
+        self.db = defaultdict(FakeCollection)
+
+        patches = [
+            mock.patch('gdam.processor.zmq'),
+            mock.patch('gdam.processor.pymongo.MongoClient', return_value={'GDAM': self.db}),
+            mock.patch('gutils.gbdr.GliderBDReader', side_effect=lambda paths: paths[0]),
+            mock.patch('gutils.gbdr.MergedGliderBDReader', FakeReader)
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+        FakeReader.dies = set()
+
+    def worker(self, partitioner):
+        return GliderFileProcessor(
+            zmq_url='tcp://127.0.0.1:44444',
+            mongo_url='mongodb://localhost:27017',
+            batch_size=4,
+            partitioner=partitioner
+        )
+
+    def arrive(self, processor, name):
+        open(os.path.join(self.path, name), 'w').close()
+        processor.check_for_pair(Event(self.path, name))
+
+    def test_pair_killed_mid_segment_is_inserted_again(self):
+        # The first worker dies after writing one batch of a-1
+        FakeReader.dies = {'a-1.sbd'}
+        first = self.worker(FakePartitioner(owner=True))
+        self.arrive(first, 'a-1.sbd')
+        self.arrive(first, 'a-1.tbd')
+
+        data = self.db['usf-bass.unknown.sbdtbd']
+        files = self.db['usf-bass.unknown.processed_files']
+        assert len(data.documents) == 4
+        assert 'end_timestamp' not in files.documents[0]
+
+        FakeReader.dies = set()
+        second = self.worker(FakePartitioner(owner=True, took_over=True))
+        self.arrive(second, 'a-2.sbd')
+        self.arrive(second, 'a-2.tbd')
+
+        records = {d['flight_file']: d for d in files.documents}
+        assert sorted(records) == ['a-1.sbd', 'a-2.sbd']
+        assert all('end_timestamp' in r for r in records.values())
+        for record in records.values():
+            rows = data.find({'file_set_id': record['_id']})
+            assert [r['m_depth-m'] for r in rows] == [float(t) for t in range(12)]
+        assert len(data.documents) == 24
+        assert second.socket.send_json.call_count == 2
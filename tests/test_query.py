@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+import unittest
+from unittest import mock
+from datetime import datetime
+
+from gdam.query import GliderQuery, in_bbox
+
+
+class TestGliderQuery(unittest.TestCase):
+
+    def setUp(self):
+        # MongoClient connects lazily, nothing is queried here
+        self.query = GliderQuery('mongodb://localhost:27017')
+
+    def test_row_pipeline(self):
+        start = datetime(2016, 6, 24)
+        end = datetime(2016, 6, 25)
+        pipeline = self.query.row_pipeline(
+            start=start,
+            end=end,
+            bbox=(-84, 26, -82, 28),
+            sensors=['m_depth-m']
+        )
+        match = pipeline[0]['$match']
+        assert match['timestamp'] == {'$gte': start, '$lt': end}
+        assert '$geoWithin' in match['m_gps_lonlat-lonlat']
+        assert pipeline[1] == {'$sort': {'timestamp': 1}}
+        assert pipeline[2]['$project']['m_depth-m'] == 1
+
+    def test_binned_pipeline(self):
+        pipeline = self.query.row_pipeline(sensors=['m_depth-m'], bin_seconds=60)
+        group = pipeline[0]['$group']
+        assert group['m_depth-m'] == {'$avg': '$m_depth-m'}
+        assert group['count'] == {'$sum': 1}
+
+        with self.assertRaises(ValueError):
+            self.query.row_pipeline(bin_seconds=60)
+
+    def test_in_bbox(self):
+        bbox = (-84, 26, -82, 28)
+        assert in_bbox({'type': 'Point', 'coordinates': [-83, 27]}, bbox) is True
+        assert in_bbox({'type': 'Point', 'coordinates': [-80, 27]}, bbox) is False
+        assert in_bbox(None, bbox) is False
+
+    def test_is_bucketed_by_collection_name(self):
+        collection = mock.Mock()
+        collection.name = 'usf-bass.unknown.sbdtbd.buckets'
+        assert self.query.is_bucketed(collection) is True
+
+        collection.name = 'usf-bass.unknown.sbdtbd'
+        assert self.query.is_bucketed(collection) is False
+
+    def test_rows_and_buckets_of_one_pair_are_merged(self):
+        # Buckets were turned on partway through the deployment
+        rows = mock.Mock()
+        rows.name = 'usf-bass.unknown.sbdtbd'
+        rows.aggregate.return_value = [
+            {'timestamp': datetime(2016, 6, 24, 18, 0, t), 'm_depth-m': float(t)}
+            for t in (0, 1)
+        ]
+        buckets = mock.Mock()
+        buckets.name = 'usf-bass.unknown.sbdtbd.buckets'
+        buckets.aggregate.return_value = [{
+            'file_set_id': 'fileset',
+            'count': 2,
+            'columns': {
+                'timestamp': [datetime(2016, 6, 24, 18, 0, t) for t in (2, 3)],
+                'm_depth-m': [2.0, 3.0]
+            }
+        }]
+
+        collections = {c.name: c for c in (rows, buckets)}
+        self.query.db = mock.MagicMock()
+        self.query.db.list_collection_names.return_value = list(collections) + [
+            'usf-bass.unknown.processed_files'
+        ]
+        self.query.db.__getitem__.side_effect = collections.__getitem__
+
+        depths = [r['m_depth-m'] for r in self.query.rows('usf-bass')]
+        assert depths == [0.0, 1.0, 2.0, 3.0]
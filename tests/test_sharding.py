@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+import unittest
+from unittest import mock
+
+from pymongo.errors import DuplicateKeyError
+
+from gdam.sharding import StaticPartitioner, LeasePartitioner
+
+
+class TestStaticPartitioner(unittest.TestCase):
+
+    def test_each_glider_has_one_owner(self):
+        workers = [StaticPartitioner(i, 3) for i in range(3)]
+        gliders = ['usf-bass', 'usf-sam', 'usf-gansett', 'ru22', 'bass__20160624T1800']
+        for glider in gliders:
+            owners = [w for w in workers if w.owns(glider)]
+            assert len(owners) == 1
+
+    def test_invalid_index(self):
+        with self.assertRaises(ValueError):
+            StaticPartitioner(3, 3)
+
+
+class TestLeasePartitioner(unittest.TestCase):
+
+    def setUp(self):
+        with mock.patch('gdam.sharding.pymongo.MongoClient'):
+            self.partitioner = LeasePartitioner(
+                'mongodb://localhost:27017',
+                worker_id='worker-a',
+                lease_seconds=300
+            )
+        self.partitioner.collection = mock.MagicMock()
+        self.find = self.partitioner.collection.find_one_and_update
+
+    def test_new_lease(self):
+        self.find.return_value = None
+        assert self.partitioner.owns('usf-bass') is True
+        assert self.partitioner.took_over('usf-bass') is False
+
+        query, update = self.find.call_args[0]
+        assert query['_id'] == 'usf-bass'
+        assert update['$set']['owner'] == 'worker-a'
+
+    def test_renewed_lease(self):
+        self.find.return_value = {'_id': 'usf-bass', 'owner': 'worker-a'}
+        assert self.partitioner.owns('usf-bass') is True
+        assert self.partitioner.took_over('usf-bass') is False
+
+    def test_held_by_another_worker(self):
+        self.find.side_effect = DuplicateKeyError('usf-bass')
+        assert self.partitioner.owns('usf-bass') is False
+
+    def test_takeover_is_reported_once(self):
+        self.find.return_value = {'_id': 'usf-bass', 'owner': 'worker-b'}
+        assert self.partitioner.owns('usf-bass') is True
+        assert self.partitioner.took_over('usf-bass') is True
+        assert self.partitioner.took_over('usf-bass') is False
+
+    def test_renew_and_release(self):
+        self.partitioner.renew()
+        query, update = self.partitioner.collection.update_many.call_args[0]
+        assert query == {'owner': 'worker-a'}
+        assert 'expires' in update['$set']
+
+        self.partitioner.start()
+        self.partitioner.release()
+        assert not self.partitioner.renewer.is_alive()
+        # Leases are expired, not deleted, so the next owner sees a takeover
+        assert self.partitioner.collection.delete_many.called is False